@@ -5,11 +5,16 @@ about both sets of data.
 """
 
 
+# Built-in
+import functools
+import glob
+import hashlib
+import os
+import tempfile
+
 # Libs
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objs as go
-from tqdm import tqdm
 
 __author__ = 'Brayant Lopez'
 __copyright__ = 'Copyright 2023, Tailored Alloys'
@@ -18,8 +23,16 @@ __version__ = '0.0.2'
 
 # Global Variables
 LAYER_THICKNESS = 0.05              # Layer thickness in mm
+NUMBER_OF_LAYERS = 847              # Layers in the build
+MAX_CACHED_FIGURES = 16            # Layer figures kept by plot_layer_n
 LASER_ON = True                     # If True, only the points with laser on will be loaded
 LASER_OFF = False                   # If True, only the points with laser off will be loaded
+MONITORING_DTYPES = {'x': 'float32', 'y': 'float32', 'power': 'float32', 'laser_status': 'int8'}
+MONITORING_COLUMNS = list(MONITORING_DTYPES)                # Only columns read from the monitoring files
+POROSITY_DTYPES = {'Center x [mm]': 'float64', 'Center y [mm]': 'float64', 'Center z [mm]': 'float64',
+                   'Radius [mm]': 'float64'}                # float64, z is binned into 0.05 mm layers
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pore-predictor')   # Parsed porosity files
+CACHE_VERSION = 2                   # Bump when the porosity parsing changes, invalidates CACHE_DIR
 
 
 def build_layer_id(i:int):
@@ -28,18 +41,124 @@ def build_layer_id(i:int):
     :param i: layer number
     :return: layer id
     """
-    j = i//10
-    if j < 1:
-        return f'00{i}'
-    elif 1<=j<10:
-        return f'0{i}'
-    else:
-        return f'{i}'
+    return f'{i:03d}'
+
+
+def z_to_layer(z:np.ndarray):
+    """
+    Converts the z coordinates of the pores into layer numbers. The build starts at z = -18 mm.
+    np.round can pick the other side of a half-way value than Python's round(), which moves pores sitting
+    on a layer boundary to the next layer, so the few heights close to half-way are rounded with round().
+    :param z: array with the z coordinates in mm
+    :return: array with the layer numbers
+    """
+    heights = np.asarray(z, dtype=np.float64) + 18
+    rounded = np.round(heights, 3)
+    half_way = np.abs((heights * 1000) % 1 - 0.5) < 1e-6
+    rounded[half_way] = [round(h, 3) for h in heights[half_way].tolist()]
+    return (rounded / LAYER_THICKNESS).astype(np.int64)
+
+
+def _histogram(df:pd.DataFrame):
+    """
+    Counts the pores per layer, layers without pores included.
+    :param df: df with the porosity data
+    :return: df with the number of pores per layer
+    """
+    layer = df['layer'].to_numpy()
+    counts = np.bincount(layer[(layer >= 1) & (layer <= NUMBER_OF_LAYERS)], minlength=NUMBER_OF_LAYERS + 1)
+    return pd.DataFrame({"layer": np.arange(1, NUMBER_OF_LAYERS + 1), "pores": counts[1:]})
+
+
+def _disk_cache(func):
+    """
+    Persists the df returned by func(filepath) as parquet in CACHE_DIR. The cache key is the file path,
+    its modification time, CACHE_VERSION and the parsing settings, so editing the file or the parsing
+    invalidates it, and the outdated entries of that file are removed when the new one is written.
+    The cache is best effort: if CACHE_DIR cannot be read or written the file is just parsed.
+    Set the PORE_PREDICTOR_NO_CACHE environment variable to 1/true/yes to always parse the file.
+    """
+    @functools.wraps(func)
+    def wrapper(filepath:str):
+        if os.environ.get('PORE_PREDICTOR_NO_CACHE', '').strip().lower() in ('1', 'true', 'yes', 'on'):
+            return func(filepath)
+        source = f"{func.__module__}.{func.__name__}|{os.path.abspath(filepath)}"
+        key = f"{CACHE_VERSION}|{__version__}|{os.path.getmtime(filepath)}|{LAYER_THICKNESS}|{POROSITY_DTYPES}"
+        prefix = hashlib.sha1(source.encode()).hexdigest()
+        cache_file = os.path.join(CACHE_DIR, f"{prefix}-{hashlib.sha1(key.encode()).hexdigest()}.parquet")
+        if os.path.exists(cache_file):
+            try:
+                return pd.read_parquet(cache_file)
+            except (OSError, ValueError):                   # unreadable entry, parse and overwrite it
+                pass
+        df = func(filepath)
+        tmp_file = None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=CACHE_DIR, suffix='.parquet.tmp')
+            os.close(fd)
+            df.to_parquet(tmp_file)
+            os.replace(tmp_file, cache_file)                # atomic, readers never see a partial file
+            for outdated in glob.glob(os.path.join(CACHE_DIR, f"{prefix}-*.parquet")):
+                if outdated != cache_file:
+                    os.remove(outdated)
+        except OSError:
+            pass
+        finally:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return df
+    return wrapper
+
+
+@_disk_cache
+def _read_porosity(filepath:str):
+    """
+    Reads the xct porosity file, adds the layer column and drops the pores outside the build area.
+    :param filepath: path to the xct porosity csv
+    :return: df with the porosity data
+    """
+    df = pd.read_csv(filepath, engine='pyarrow', usecols=list(POROSITY_DTYPES), dtype=POROSITY_DTYPES)
+    df['layer'] = z_to_layer(df['Center z [mm]'].to_numpy())
+    #
+    ax = np.abs(df['Center x [mm]'].to_numpy())
+    ay = np.abs(df['Center y [mm]'].to_numpy())
+    return df.loc[(ax < 25.18) & (ay < 25.18 - ax)]
+
+
+@functools.lru_cache(maxsize=64)
+def _load_layer_cached(monitoring_source:str, n:int, laser_on:bool, laser_off:bool):
+    """
+    Reads and filters the monitoring data for the layer n, either from the directory with the csv files or
+    from the .h5 file built by MonitoringPorosity.monitoring_to_h5. Results are cached, so the returned df is shared
+    between calls and must be treated as read-only.
+    """
+    laser_status = None
+    if laser_on and not laser_off:
+        laser_status = 1
+    elif laser_off and not laser_on:
+        laser_status = 0
+
+    if monitoring_source.endswith('.h5'):
+        where = 'power > 2700'                              # ad hoc
+        if laser_status is not None:
+            where += f' & laser_status == {laser_status}'
+        df = pd.read_hdf(monitoring_source, key=f'layer_{build_layer_id(n)}', where=where,
+                         columns=MONITORING_COLUMNS)
+        return df.iloc[::10, :]
+
+    filepath = f"{monitoring_source}/transformed_id-{build_layer_id(n)}.csv"
+    df = pd.read_csv(filepath, engine='pyarrow', usecols=MONITORING_COLUMNS, dtype=MONITORING_DTYPES)
+    keep = df['power'].to_numpy() > 2700                    # ad hoc
+    if laser_status is not None:
+        keep &= df['laser_status'].to_numpy() == laser_status
+    return df.loc[keep].iloc[::10, :]
 
 
 class MonitoringPorosity:
     """
     Takes the XCT porosity file in the CAD coordinates and the directory with the monitoring files.
+    The monitoring files can also be given as the single .h5 file built by MonitoringPorosity.monitoring_to_h5().
     Provides a set of tools to visualize and get an overview of porosity and monitoring.
     Public Methods:
         - load_monitoring_layer()-> df          # Loads the monitoring file for the layer n.
@@ -57,10 +176,14 @@ class MonitoringPorosity:
         self.monitoring_files_dir = monitoring_layers_dir
 
         self.porosity_df = self._create_porosity_df()
-        self.porosity_per_layer = self._get_porosity_histogram_df()
+        self.porosity_per_layer = _histogram(self.porosity_df)
 
         self.porosity_df2 = self._create_pores2_df()
-        self.porosity2_per_layer = self._get_pore_histogram_df2()
+        self.porosity2_per_layer = _histogram(self.porosity_df2)
+
+        self._pores_by_layer = dict(tuple(self.porosity_df.groupby('layer', sort=False)))
+        self._pores2_by_layer = dict(tuple(self.porosity_df2.groupby('layer', sort=False)))
+        self._figures = {}
 
         self.combined_df = self._combine_df()
 
@@ -70,12 +193,7 @@ class MonitoringPorosity:
         checks that the pores are within the range.
         :return: df with the porosity data
         """
-        df = pd.read_csv(self.xct_porosity_file)
-        df['layer'] = (df['Center z [mm]'].apply(lambda x: int(round(x+18, 3) / LAYER_THICKNESS)))
-        #
-        df = df[(df['Center x [mm]'] > -25.18) & (df['Center x [mm]'] < 25.18)]
-        df = df[(df['Center y [mm]'] > (25.18 - df['Center x [mm]'].abs())*-1) & (df['Center y [mm]'] < (25.18 - df['Center x [mm]'].abs()))]
-        return df
+        return _read_porosity(self.xct_porosity_file)
 
     def _create_pores2_df(self):
         """
@@ -83,37 +201,7 @@ class MonitoringPorosity:
         checks that the pores are within the range.
         :return: df with the porosity data
         """
-        df = pd.read_csv(self.xct_pores2)
-        df['layer'] = (df['Center z [mm]'].apply(lambda x: int(round(x + 18, 3) / LAYER_THICKNESS)))
-        #
-        df = df[(df['Center x [mm]'] > -25.18) & (df['Center x [mm]'] < 25.18)]
-        df = df[(df['Center y [mm]'] > (25.18 - df['Center x [mm]'].abs()) * -1) & (
-                    df['Center y [mm]'] < (25.18 - df['Center x [mm]'].abs()))]
-        return df
-
-    def _get_porosity_histogram_df(self):
-        """
-        Creates a dataframe with the number of pores per layer.
-        :return: df with the number of pores per layer
-        """
-        layer_pores = []
-        layer = []
-        for i in range(1, 848):
-            layer_pores.append(len(self.porosity_df[self.porosity_df['layer'] == i]))
-            layer.append(i)
-        return pd.DataFrame.from_dict({"layer": layer, "pores": layer_pores})
-
-    def _get_pore_histogram_df2(self):
-        """
-        Creates a dataframe with the number of pores per layer.
-        :return: df with the number of pores per layer
-        """
-        layer_pores = []
-        layer = []
-        for i in range(1, 848):
-            layer_pores.append(len(self.porosity_df2[self.porosity_df2['layer'] == i]))
-            layer.append(i)
-        return pd.DataFrame.from_dict({"layer": layer, "pores": layer_pores})
+        return _read_porosity(self.xct_pores2)
 
     def load_monitoring_layer(self, n:int=1, laser_on=LASER_ON, laser_off = LASER_OFF):
         """
@@ -121,18 +209,9 @@ class MonitoringPorosity:
         :param n: layer number
         :param laser_on: if True, only the points with laser on will be loaded
         :param laser_off: if True, only the points with laser off will be loaded
-        :return: df with the monitoring data
+        :return: df with the MONITORING_COLUMNS of the monitoring data, cached between calls so it must not be modified in place
         """
-        n = build_layer_id(n)
-        filepath = f"{self.monitoring_files_dir}/transformed_id-{n}.csv"
-        df = pd.read_csv(filepath)
-        if laser_on and not laser_off:
-            df = df[df['laser_status'] == 1]
-        elif laser_off and not laser_on:
-            df = df[df['laser_status'] == 0]
-
-        df = df[(df['power'] > 2700)]                           # ad hoc
-        return df.iloc[::10, :]
+        return _load_layer_cached(self.monitoring_files_dir, n, laser_on, laser_off)
 
     def _combine_df(self):
         df = pd.DataFrame()
@@ -150,6 +229,7 @@ class MonitoringPorosity:
         :param save: if True, the plot is saved as an html file
         :return: None
         """
+        import plotly.express as px
         if name == "Renishaw":
             df = self.porosity_per_layer
         else:
@@ -170,6 +250,7 @@ class MonitoringPorosity:
 
 
     def compare_histograms(self):
+        import plotly.express as px
         df = self.combined_df
         fig = px.bar(df, x="layer", y=["Renishaw", "SLM"], title="Pore Comparison", barmode='group')
         fig.update_layout(
@@ -184,21 +265,35 @@ class MonitoringPorosity:
         fig.show()
         fig.write_html("Pore Comparison_bar.html")
 
-    def plot_layer_n(self, n: int, save=False):
+    def _layer_figure(self, n:int):
         """
-        Plots the layer n with the pores and the monitoring points.
+        Returns the figure of the layer n, building it on the first call. Only the last MAX_CACHED_FIGURES
+        layers are kept, the oldest one is dropped first.
         :param n: layer number
-        :param save: if True, the plot is saved as an html file
-        :return: None
+        :return: figure, None if there are no pores in the layer
         """
+        if n not in self._figures:
+            if len(self._figures) >= MAX_CACHED_FIGURES:
+                del self._figures[next(iter(self._figures))]
+            self._figures[n] = self._build_layer_figure(n)
+        return self._figures[n]
+
+    def _build_layer_figure(self, n:int):
+        """
+        Builds the figure of the layer n with the pores and the monitoring points. Cached per instance in
+        self._figures by _layer_figure, so the returned figure is shared and must not be modified in place.
+        :param n: layer number
+        :return: figure, None if there are no pores in the layer
+        """
+        import plotly.graph_objs as go
         monitoring_df = self.load_monitoring_layer(n)
-        porosity_df = self.porosity_df[self.porosity_df['layer'] == n]
-        porosity_df2 = self.porosity_df2[self.porosity_df2['layer'] == n]
+        porosity_df = self._pores_by_layer.get(n, self.porosity_df.iloc[0:0])
+        porosity_df2 = self._pores2_by_layer.get(n, self.porosity_df2.iloc[0:0])
         if len(porosity_df) == 0:
             return
         trace_pores = go.Scatter(x=porosity_df['Center x [mm]'], y=porosity_df['Center y [mm]'], mode='markers',
                                  marker=dict(color='red'), name='Renishaw pores')
-        trace_monitoring = go.Scatter(x=monitoring_df['x'], y=monitoring_df['y'], mode='markers', opacity=0.3,
+        trace_monitoring = go.Scattergl(x=monitoring_df['x'], y=monitoring_df['y'], mode='markers', opacity=0.3,
                                       hovertext=monitoring_df['power'],
                                       marker=dict(color="gray", colorscale='bluered'), name='monitoring')
         trace_pores2 = go.Scatter(x=porosity_df2['Center x [mm]'], y=porosity_df2['Center y [mm]'], mode='markers',
@@ -218,6 +313,18 @@ class MonitoringPorosity:
                 color="RebeccaPurple"
             )
         )
+        return fig
+
+    def plot_layer_n(self, n: int, save=False):
+        """
+        Plots the layer n with the pores and the monitoring points.
+        :param n: layer number
+        :param save: if True, the plot is saved as an html file
+        :return: None
+        """
+        fig = self._layer_figure(n)
+        if fig is None:
+            return
         #fig.show()
         if save: fig.write_html(f"Comparison layer {n} pores.html")
 
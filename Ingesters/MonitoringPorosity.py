@@ -5,11 +5,18 @@ about both sets of data.
 """
 
 
+# Built-in
+import functools
+import glob
+import hashlib
+import math
+import multiprocessing as mp
+import os
+import tempfile
+
 # Libs
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objs as go
-from tqdm import tqdm
 
 __author__ = 'Brayant Lopez'
 __copyright__ = 'Copyright 2023, Tailored Alloys'
@@ -18,8 +25,17 @@ __version__ = '0.0.2'
 
 # Global Variables
 LAYER_THICKNESS = 0.05              # Layer thickness in mm
+NUMBER_OF_LAYERS = 847              # Layers in the build
+MAX_CACHED_FIGURES = 16            # Layer figures kept by plot_layer_n
+MAX_IMAGE_POINTS = 50000            # Monitoring points drawn in a saved image
 LASER_ON = True                     # If True, only the points with laser on will be loaded
 LASER_OFF = False                   # If True, only the points with laser off will be loaded
+MONITORING_DTYPES = {'x': 'float32', 'y': 'float32', 'power': 'float32', 'laser_status': 'int8'}
+MONITORING_COLUMNS = list(MONITORING_DTYPES)                # Only columns read from the monitoring files
+POROSITY_DTYPES = {'Center x [mm]': 'float64', 'Center y [mm]': 'float64', 'Center z [mm]': 'float64',
+                   'Radius [mm]': 'float64'}                # float64, z is binned into 0.05 mm layers
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pore-predictor')   # Parsed porosity files
+CACHE_VERSION = 2                   # Bump when the porosity parsing changes, invalidates CACHE_DIR
 
 
 def build_layer_id(i:int):
@@ -28,18 +44,171 @@ def build_layer_id(i:int):
     :param i: layer number
     :return: layer id
     """
-    j = i//10
-    if j < 1:
-        return f'00{i}'
-    elif 1<=j<10:
-        return f'0{i}'
-    else:
-        return f'{i}'
+    return f'{i:03d}'
+
+
+def z_to_layer(z:np.ndarray):
+    """
+    Converts the z coordinates of the pores into layer numbers. The build starts at z = -18 mm.
+    np.round can pick the other side of a half-way value than Python's round(), which moves pores sitting
+    on a layer boundary to the next layer, so the few heights close to half-way are rounded with round().
+    :param z: array with the z coordinates in mm
+    :return: array with the layer numbers
+    """
+    heights = np.asarray(z, dtype=np.float64) + 18
+    rounded = np.round(heights, 3)
+    half_way = np.abs((heights * 1000) % 1 - 0.5) < 1e-6
+    rounded[half_way] = [round(h, 3) for h in heights[half_way].tolist()]
+    return (rounded / LAYER_THICKNESS).astype(np.int64)
+
+
+def _histogram(df:pd.DataFrame):
+    """
+    Counts the pores per layer, layers without pores included.
+    :param df: df with the porosity data
+    :return: df with the number of pores per layer
+    """
+    layer = df['layer'].to_numpy()
+    counts = np.bincount(layer[(layer >= 1) & (layer <= NUMBER_OF_LAYERS)], minlength=NUMBER_OF_LAYERS + 1)
+    return pd.DataFrame({"layer": np.arange(1, NUMBER_OF_LAYERS + 1), "pores": counts[1:]})
+
+
+def _disk_cache(func):
+    """
+    Persists the df returned by func(filepath) as parquet in CACHE_DIR. The cache key is the file path,
+    its modification time, CACHE_VERSION and the parsing settings, so editing the file or the parsing
+    invalidates it, and the outdated entries of that file are removed when the new one is written.
+    The cache is best effort: if CACHE_DIR cannot be read or written the file is just parsed.
+    Set the PORE_PREDICTOR_NO_CACHE environment variable to 1/true/yes to always parse the file.
+    """
+    @functools.wraps(func)
+    def wrapper(filepath:str):
+        if os.environ.get('PORE_PREDICTOR_NO_CACHE', '').strip().lower() in ('1', 'true', 'yes', 'on'):
+            return func(filepath)
+        source = f"{func.__module__}.{func.__name__}|{os.path.abspath(filepath)}"
+        key = f"{CACHE_VERSION}|{__version__}|{os.path.getmtime(filepath)}|{LAYER_THICKNESS}|{POROSITY_DTYPES}"
+        prefix = hashlib.sha1(source.encode()).hexdigest()
+        cache_file = os.path.join(CACHE_DIR, f"{prefix}-{hashlib.sha1(key.encode()).hexdigest()}.parquet")
+        if os.path.exists(cache_file):
+            try:
+                return pd.read_parquet(cache_file)
+            except (OSError, ValueError):                   # unreadable entry, parse and overwrite it
+                pass
+        df = func(filepath)
+        tmp_file = None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=CACHE_DIR, suffix='.parquet.tmp')
+            os.close(fd)
+            df.to_parquet(tmp_file)
+            os.replace(tmp_file, cache_file)                # atomic, readers never see a partial file
+            for outdated in glob.glob(os.path.join(CACHE_DIR, f"{prefix}-*.parquet")):
+                if outdated != cache_file:
+                    os.remove(outdated)
+        except OSError:
+            pass
+        finally:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return df
+    return wrapper
+
+
+@_disk_cache
+def _read_porosity(filepath:str):
+    """
+    Reads the xct porosity file, adds the layer column and drops the pores outside the build area.
+    :param filepath: path to the xct porosity csv
+    :return: df with the porosity data
+    """
+    df = pd.read_csv(filepath, engine='pyarrow', dtype=POROSITY_DTYPES)
+    df['layer'] = z_to_layer(df['Center z [mm]'].to_numpy())
+    #
+    ax = np.abs(df['Center x [mm]'].to_numpy())
+    ay = np.abs(df['Center y [mm]'].to_numpy())
+    return df.loc[(ax < 25.18) & (ay < 25.18 - ax)]
+
+
+@functools.lru_cache(maxsize=64)
+def _load_layer_cached(monitoring_source:str, n:int, laser_on:bool, laser_off:bool):
+    """
+    Reads and filters the monitoring data for the layer n, either from the directory with the csv files or
+    from the .h5 file built by monitoring_to_h5. Results are cached, so the returned df is shared
+    between calls and must be treated as read-only.
+    """
+    laser_status = None
+    if laser_on and not laser_off:
+        laser_status = 1
+    elif laser_off and not laser_on:
+        laser_status = 0
+
+    if monitoring_source.endswith('.h5'):
+        where = 'power > 2700'                              # ad hoc
+        if laser_status is not None:
+            where += f' & laser_status == {laser_status}'
+        df = pd.read_hdf(monitoring_source, key=f'layer_{build_layer_id(n)}', where=where,
+                         columns=MONITORING_COLUMNS)
+        return df.iloc[::10, :]
+
+    filepath = f"{monitoring_source}/transformed_id-{build_layer_id(n)}.csv"
+    df = pd.read_csv(filepath, engine='pyarrow', usecols=MONITORING_COLUMNS, dtype=MONITORING_DTYPES)
+    keep = df['power'].to_numpy() > 2700                    # ad hoc
+    if laser_status is not None:
+        keep &= df['laser_status'].to_numpy() == laser_status
+    return df.loc[keep].iloc[::10, :]
+
+
+def monitoring_to_h5(monitoring_layers_dir:str, output_file:str, layers=range(1, NUMBER_OF_LAYERS + 1)):
+    """
+    Packs the MONITORING_COLUMNS of every layer into a single HDF5 file with one table per layer.
+    laser_status and power are stored as data columns, so the filters are applied while reading.
+    :param monitoring_layers_dir: directory with the transformed_id-00i.csv files
+    :param output_file: path of the .h5 file, to be passed to MonitoringPorosity as monitoring_layers_dir
+    :param layers: layer numbers to pack, layers without a file are skipped
+    :return: None
+    """
+    for n in layers:
+        layer_id = build_layer_id(n)
+        filepath = f"{monitoring_layers_dir}/transformed_id-{layer_id}.csv"
+        if not os.path.exists(filepath):
+            continue
+        df = pd.read_csv(filepath, engine='pyarrow', usecols=MONITORING_COLUMNS, dtype=MONITORING_DTYPES)
+        df.to_hdf(output_file, key=f"layer_{layer_id}", format="table",
+                  data_columns=['laser_status', 'power'], index=False)
+
+
+def save_layer_image(monitoring_source:str, n:int, porosity_df:pd.DataFrame):
+    """
+    Saves the image of the layer n with the pores and the monitoring points. It only takes what the layer
+    needs, so it can be sent to worker processes by MonitoringPorosity.save_images.
+    :param monitoring_source: directory with the monitoring files or .h5 file
+    :param n: layer number
+    :param porosity_df: df with the pores in the layer n
+    :return: None
+    """
+    import plotly.graph_objs as go
+    if len(porosity_df) == 0:
+        return
+    monitoring_df = _load_layer_cached(monitoring_source, n, LASER_ON, LASER_OFF)
+    step = max(1, math.ceil(len(monitoring_df) / MAX_IMAGE_POINTS))
+    monitoring_df = monitoring_df.iloc[::step]
+    trace_pores = go.Scatter(x=porosity_df['Center x [mm]'], y=porosity_df['Center y [mm]'], mode='markers',
+                             marker=dict(color='red'), name='pore')
+    trace_monitoring = go.Scattergl(x=monitoring_df['x'], y=monitoring_df['y'], mode='markers', opacity= 0.5,
+                                  marker=dict(color='gray'), name='monitoring')
+    fig = go.Figure(data=[trace_pores, trace_monitoring])
+    fig.update_layout(showlegend=False, plot_bgcolor='rgba(0, 0, 0, 0)',
+                            paper_bgcolor='rgba(0, 0, 0, 0)')
+    fig.update_yaxes(visible=False)
+    fig.update_xaxes(visible=False)
+
+    fig.write_image(f"images/layer {n} pores.png", width=1800, height=1800)
 
 
 class MonitoringPorosity:
     """
     Takes the XCT porosity file in the CAD coordinates and the directory with the monitoring files.
+    The monitoring files can also be packed into a single .h5 file with monitoring_to_h5().
     Provides a set of tools to visualize and get an overview of porosity and monitoring.
     Public Methods:
         - load_monitoring_layer()-> df          # Loads the monitoring file for the layer n.
@@ -47,6 +216,7 @@ class MonitoringPorosity:
         - plot_histogram()-> None               # Plots the histogram of the number of pores per layer.
         - plot_layer_n()-> None                 # Plots the layer n with the pores and the monitoring points.
         - save_image()-> None                   # Saves the image of the layer n with the pores and the monitoring points.
+        - save_images()-> None                  # Saves the images of several layers in parallel.
         - get_pores_in_layer_n()-> df           # Returns the pores in the layer n.
         - get_largest_pore()-> df               # Returns the largest pore in the porosity data.
     """
@@ -56,7 +226,9 @@ class MonitoringPorosity:
         self.monitoring_files_dir = monitoring_layers_dir
 
         self.porosity_df = self._create_porosity_df()
-        self.porosity_per_layer = self._get_porosity_histogram_df()
+        self.porosity_per_layer = _histogram(self.porosity_df)
+        self._pores_by_layer = dict(tuple(self.porosity_df.groupby('layer', sort=False)))
+        self._figures = {}
 
     def _create_porosity_df(self):
         """
@@ -64,24 +236,7 @@ class MonitoringPorosity:
         checks that the pores are within the range.
         :return: df with the porosity data
         """
-        df = pd.read_csv(self.xct_porosity_file)
-        df['layer'] = (df['Center z [mm]'].apply(lambda x: int(round(x+18, 3) / LAYER_THICKNESS)))
-        #
-        df = df[(df['Center x [mm]'] > -25.18) & (df['Center x [mm]'] < 25.18)]
-        df = df[(df['Center y [mm]'] > (25.18 - df['Center x [mm]'].abs())*-1) & (df['Center y [mm]'] < (25.18 - df['Center x [mm]'].abs()))]
-        return df
-
-    def _get_porosity_histogram_df(self):
-        """
-        Creates a dataframe with the number of pores per layer.
-        :return: df with the number of pores per layer
-        """
-        layer_pores = []
-        layer = []
-        for i in range(1, 848):
-            layer_pores.append(len(self.porosity_df[self.porosity_df['layer'] == i]))
-            layer.append(i)
-        return pd.DataFrame.from_dict({"layer": layer, "pores": layer_pores})
+        return _read_porosity(self.xct_porosity_file)
 
     def load_monitoring_layer(self, n:int=1, laser_on=LASER_ON, laser_off = LASER_OFF):
         """
@@ -89,18 +244,9 @@ class MonitoringPorosity:
         :param n: layer number
         :param laser_on: if True, only the points with laser on will be loaded
         :param laser_off: if True, only the points with laser off will be loaded
-        :return: df with the monitoring data
+        :return: df with the MONITORING_COLUMNS of the monitoring data, cached between calls so it must not be modified in place
         """
-        n = build_layer_id(n)
-        filepath = f"{self.monitoring_files_dir}/transformed_id-{n}.csv"
-        df = pd.read_csv(filepath)
-        if laser_on and not laser_off:
-            df = df[df['laser_status'] == 1]
-        elif laser_off and not laser_on:
-            df = df[df['laser_status'] == 0]
-
-        df = df[(df['power'] > 2700)]                           # ad hoc
-        return df.iloc[::10, :]
+        return _load_layer_cached(self.monitoring_files_dir, n, laser_on, laser_off)
 
     def get_layers_with_most_pores(self, number_of_layers:int):
         """
@@ -108,8 +254,7 @@ class MonitoringPorosity:
         :param number_of_layers: number of layers to return
         :return: df with the layers with the most pores
         """
-        df = self.porosity_per_layer.sort_values(by='pores', ascending=False)
-        return(df.head(number_of_layers))
+        return self.porosity_per_layer.nlargest(number_of_layers, 'pores')
 
     def plot_histogram(self, name:str = 'UTEP45',save=False):
         """
@@ -118,6 +263,7 @@ class MonitoringPorosity:
         :param save: if True, the plot is saved as an html file
         :return: None
         """
+        import plotly.express as px
         hist = px.histogram(self.porosity_per_layer, x="layer", y="pores", nbins=len(self.porosity_per_layer))
         hist.update_layout(
             title=f"{name} Pores Distribution",
@@ -132,20 +278,34 @@ class MonitoringPorosity:
         hist.show()
         if save: hist.to_html(f"{name}_porosity_distribution.html")
 
-    def plot_layer_n(self, n:int, save=False):
+    def _layer_figure(self, n:int):
         """
-        Plots the layer n with the pores and the monitoring points.
+        Returns the figure of the layer n, building it on the first call. Only the last MAX_CACHED_FIGURES
+        layers are kept, the oldest one is dropped first.
         :param n: layer number
-        :param save: if True, the plot is saved as an html file
-        :return: None
+        :return: figure, None if there are no pores in the layer
         """
+        if n not in self._figures:
+            if len(self._figures) >= MAX_CACHED_FIGURES:
+                del self._figures[next(iter(self._figures))]
+            self._figures[n] = self._build_layer_figure(n)
+        return self._figures[n]
+
+    def _build_layer_figure(self, n:int):
+        """
+        Builds the figure of the layer n with the pores and the monitoring points. Cached per instance in
+        self._figures by _layer_figure, so the returned figure is shared and must not be modified in place.
+        :param n: layer number
+        :return: figure, None if there are no pores in the layer
+        """
+        import plotly.graph_objs as go
         monitoring_df = self.load_monitoring_layer(n)
-        porosity_df = self.porosity_df[self.porosity_df['layer'] == n]
+        porosity_df = self._pores_in_layer(n)
         if len(porosity_df) == 0:
             return
         trace_pores = go.Scatter(x=porosity_df['Center x [mm]'], y=porosity_df['Center y [mm]'], mode='markers',
                                  marker=dict(color='red'), name='pores')
-        trace_monitoring = go.Scatter(x=monitoring_df['x'], y=monitoring_df['y'], mode='markers', opacity= 0.3, hovertext=monitoring_df['power'],
+        trace_monitoring = go.Scattergl(x=monitoring_df['x'], y=monitoring_df['y'], mode='markers', opacity= 0.3, hovertext=monitoring_df['power'],
                                       marker=dict(color="gray", colorscale='bluered'), name='monitoring')
                                       # hovertemplate="x: %{x}<br>" +
                                       #               "y: %{y}<br>" +
@@ -162,6 +322,18 @@ class MonitoringPorosity:
                 color="RebeccaPurple"
             )
         )
+        return fig
+
+    def plot_layer_n(self, n:int, save=False):
+        """
+        Plots the layer n with the pores and the monitoring points.
+        :param n: layer number
+        :param save: if True, the plot is saved as an html file
+        :return: None
+        """
+        fig = self._layer_figure(n)
+        if fig is None:
+            return
         fig.show()
         if save: fig.write_html(f"layer {n} pores.html")
 
@@ -171,43 +343,49 @@ class MonitoringPorosity:
         :param n: layer number
         :return: None
         """
-        monitoring_df = self.load_monitoring_layer(n)
-        porosity_df = self.porosity_df[self.porosity_df['layer'] == n]
-        if len(porosity_df) == 0:
-            return
-        trace_pores = go.Scatter(x=porosity_df['Center x [mm]'], y=porosity_df['Center y [mm]'], mode='markers',
-                                 marker=dict(color='red'), name='pore')
-        trace_monitoring = go.Scatter(x=monitoring_df['x'], y=monitoring_df['y'], mode='markers', opacity= 0.5,
-                                      marker=dict(color='gray'), name='monitoring')
-        fig = go.Figure(data=[trace_pores, trace_monitoring])
-        fig.update_layout(showlegend=False, plot_bgcolor='rgba(0, 0, 0, 0)',
-                                paper_bgcolor='rgba(0, 0, 0, 0)')
-        fig.update_yaxes(visible=False)
-        fig.update_xaxes(visible=False)
+        save_layer_image(self.monitoring_files_dir, n, self._pores_in_layer(n))
 
-
-        fig.write_image(f"images/layer {n} pores.png", width=1800, height=1800)
+    def save_images(self, layers, processes:int=None):
+        """
+        Saves the images of several layers in parallel, one layer per task. Only worth it for many layers,
+        since every worker process has to import plotly and start its own image export.
+        :param layers: layer numbers
+        :param processes: number of worker processes, defaults to the number of cpus
+        :return: None
+        """
+        tasks = [(self.monitoring_files_dir, n, self._pores_in_layer(n)) for n in layers
+                 if n in self._pores_by_layer]
+        with mp.Pool(processes) as pool:
+            pool.starmap(save_layer_image, tasks)
 
     def get_pores_in_layer_n(self, n):
         """
         Returns the pores in the layer n.
         :param n: layer number
-        :return: df with the pores in the layer n
+        :return: df with the pores in the layer n, a copy that can be modified freely
         """
-        porosity_df = self.porosity_df[self.porosity_df['layer'] == n]
-        return porosity_df
+        return self._pores_in_layer(n).copy()
+
+    def _pores_in_layer(self, n):
+        """
+        Returns the pores in the layer n from the per layer dict, shared between calls so it must be treated
+        as read-only.
+        """
+        return self._pores_by_layer.get(n, self.porosity_df.iloc[0:0])
 
     def get_largest_pore(self):
         """
         Returns the largest pore in the porosity data.
         :return: df with the largest pore
         """
-        df = self.porosity_df.sort_values(by='Radius [mm]', ascending=False)
-        return df.head(1)
+        return self.porosity_df.nlargest(1, 'Radius [mm]')
 
     def pores_csv(self, output_name):
         self.porosity_df.to_csv(output_name, index=False)
 
+    def pores_parquet(self, output_name):
+        self.porosity_df.to_parquet(output_name, index=False)
+
 
 
 
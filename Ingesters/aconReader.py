@@ -6,6 +6,7 @@ into the common monitoring file csv.
 # Built-in
 import os
 import configparser
+import multiprocessing as mp
 
 # Libs
 import pandas as pd
@@ -35,13 +36,7 @@ def layer_thickness_to_num(filepath:str)->int:
 
 
 def get_layer_to_string(layer_num:int)->str:
-    i = layer_num/10
-    if i<1:
-        return f'00{layer_num}'
-    elif 1<=i<10:
-        return f'0{layer_num}'
-    else:
-        return f'{layer_num}'
+    return f'{layer_num:03d}'
 
 
 class AconityFileReader:
@@ -57,27 +52,30 @@ class AconityFileReader:
 
     def _create_df(self):
 
-        reader = pd.read_csv(self.filepath, delimiter=' ', skiprows=23, header=3, dtype={
-            0: int,
-            1: float,
-            2: float,
-            3: float,
-            4: int,
-            5: int,
-            6: int,
-            7: int,
-            8: int,
-            9: int,
+        # Skips the 23 preamble lines and the 4 header lines, the column names come from self.columns
+        reader = pd.read_csv(self.filepath, engine='pyarrow', delimiter=' ', skiprows=27, header=None,
+                             names=self.columns, dtype={
+            't': int,
+            'x': float,
+            'y': float,
+            'z': float,
+            'sensor_0': int,
+            'sensor_1': int,
+            'sensor_2': int,
+            'power': int,
+            'laser_status': int,
+            'state_1': int,
         })
-        reader.columns = self.columns
         return reader
 
     def _fix_df(self):
-        for col in self.columns:
-            if col != "t":
-                self._df[col] = np.roll(self._df[col], shift=OFFSET)
-            elif col == "t":
-                pass
+        """
+        Shifts every channel but the time OFFSET samples forward. All rows are rotated with a single take,
+        which copies the frame once, and then the unshifted time column is put back.
+        """
+        shifted = self._df.take(np.roll(np.arange(len(self._df)), OFFSET)).set_axis(self._df.index)
+        shifted["t"] = self._df["t"].to_numpy()
+        self._df = shifted
 
     def _get_output_file(self):
         """
@@ -90,10 +88,7 @@ class AconityFileReader:
         return f"{self._directory}/data/acon-id_{layer_num}_l1.csv"
 
     def _create_parsed_dir(self):
-        if os.path.exists(f"{self._directory}/data"):
-            return
-        else:
-            os.mkdir(f"{self._directory}/data")
+        os.makedirs(f"{self._directory}/data", exist_ok=True)
 
     def to_csv(self, output_file:str=""):
         if output_file == "":
@@ -106,3 +101,20 @@ class AconityFileReader:
         layer = f"layer_{layer_num}"
         self._df.to_hdf(output_file, key=layer, format="table", data_columns=True, index=False)
 
+
+def pcd_to_csv(filepath:str):
+    """
+    Parses a single pcd file into the common monitoring csv next to it.
+    """
+    AconityFileReader(filepath).to_csv()
+
+
+def pcds_to_csv(filepaths:list, processes:int=None):
+    """
+    Parses several pcd files in parallel, one file per task. Only worth it for several large files,
+    starting the worker processes costs more than parsing a small file.
+    :param filepaths: paths to the pcd files
+    :param processes: number of worker processes, defaults to the number of cpus
+    """
+    with mp.Pool(processes) as pool:
+        pool.map(pcd_to_csv, filepaths)
@@ -1,6 +1,38 @@
 import pandas as pd
 import numpy as np
 import json
+from numba import njit
+
+
+@njit(cache=True)
+def _layer_summary(x, y, laser):
+    """
+    Walks the layer once and returns the distance and number of samples with the laser on and off,
+    and the number of times the laser is switched on.
+    """
+    dist_on = 0.0
+    dist_off = 0.0
+    n_on = 0
+    n_off = 0
+    n_events = 0
+    for i in range(x.shape[0]):
+        length = 0.0
+        if i > 0:
+            dx = x[i] - x[i - 1]
+            dy = y[i] - y[i - 1]
+            length = np.sqrt(dx * dx + dy * dy)
+            if laser[i] - laser[i - 1] == 1:
+                n_events += 1
+        if np.isnan(length):
+            length = 0.0
+        if laser[i] == 1:
+            dist_on += length
+            n_on += 1
+        elif laser[i] == 0:
+            dist_off += length
+            n_off += 1
+    return dist_on, dist_off, n_on, n_off, n_events
+
 
 class LayerKinematics:
     """
@@ -11,21 +43,16 @@ class LayerKinematics:
     """
     def __init__(self, filepath:str):
         self.filepath = filepath
-        self.df = pd.read_csv(self.filepath)
+        self.df = pd.read_csv(self.filepath, engine='pyarrow', dtype={'laser_status': 'int8'})
 
-        self.df['length'] = np.sqrt(self.df["x"].diff() ** 2 + self.df["y"].diff() ** 2)
-        self._events()
-        self._polygon_delays()
-
-        self.time_on = float()
-        self.time_off = float()
-        self.no_events = int()
-        self.distance_on = float()
-        self.distance_off = float()
+        dist_on, dist_off, n_on, n_off, n_events = _layer_summary(
+            self.df['x'].to_numpy(), self.df['y'].to_numpy(), self.df['laser_status'].to_numpy(dtype=np.int8))
 
-        self._calculate_time_distance_on()
-        self._calculate_time_distance_off()
-        self._retrieve_no_events()
+        self.distance_on = dist_on/1000
+        self.distance_off = dist_off/1000
+        self.time_on = n_on*10/1000000
+        self.time_off = n_off*10/1000000
+        self.no_events = n_events + 1
 
         self.summary = {
             'time on': self.time_on,
@@ -37,20 +64,6 @@ class LayerKinematics:
             'number events': self.no_events
         }
 
-    def _calculate_time_distance_on(self):
-        df_on = self.df[self.df['laser_status'] == 1]
-        self.distance_on = df_on['length'].sum()/1000
-        self.time_on = len(df_on)*10/1000000
-
-    def _calculate_time_distance_off(self):
-        df_off = self.df[self.df['laser_status'] == 0]
-        self.distance_off = df_off['length'].sum()/1000
-        self.time_off = len(df_off) * 10 / 1000000
-
-    def _retrieve_no_events(self):
-        df = self.df[self.df['event'] == 1]
-        self.no_events = len(df) + 1
-
     def get_values(self):
         return self.summary
 
@@ -59,16 +72,38 @@ class LayerKinematics:
             json.dump(self.summary, fp)
 
     def to_csv(self, output_file:str):
+        self._add_columns()
         self.df.to_csv(output_file, index=False)
 
+    def _add_columns(self):
+        """
+        Adds the length, event and polygons columns, overwriting any input columns with the same name.
+        They are only needed for the csv output, the summary is computed without them.
+        """
+        self._length()
+        self._events()
+        self._polygon_delays()
+
+    def _length(self):
+        """
+        Adds the length column, the distance travelled from the previous point
+        """
+        x = self.df['x'].to_numpy()
+        y = self.df['y'].to_numpy()
+        length = np.empty(len(x))
+        length[:1] = np.nan
+        np.hypot(x[1:] - x[:-1], y[1:] - y[:-1], out=length[1:])
+        self.df['length'] = length
+
     def _events(self):
         """
         Adds the events columns and curates it
         """
-        self.df['event'] = self.df['laser_status'].diff()
-        self.df['event'] = self.df['event'].fillna(0)
-        self.df['event'] = self.df['event'].astype(int)
+        laser = self.df['laser_status'].to_numpy(dtype=np.int8)
+        event = np.empty(len(laser), dtype=np.int8)
+        event[:1] = 0
+        np.subtract(laser[1:], laser[:-1], out=event[1:])
+        self.df['event'] = event
 
     def _polygon_delays(self):
-        self.df['polygons'] = np.where(self.df['length'] == 0.0, 1, 0)
-
+        self.df['polygons'] = (self.df['length'].to_numpy() == 0.0).astype(np.int8)
@@ -1,18 +1,12 @@
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objs as go
-from plotly.subplots import make_subplots
 
 
 def read_excel(filepath):
-    xls = pd.ExcelFile(filepath)
-    df_eos = pd.read_excel(xls, 'eos')
-    df_ren = pd.read_excel(xls, 'renishaw')
-    df_slm = pd.read_excel(xls, 'slm')
-    df_aconity = pd.read_excel(xls, 'aconity')
-    return df_eos, df_ren, df_slm, df_aconity
+    sheets = pd.read_excel(filepath, sheet_name=['eos', 'renishaw', 'slm', 'aconity'])
+    return sheets['eos'], sheets['renishaw'], sheets['slm'], sheets['aconity']
 
 def plot_line(df, attribute):
+    import plotly.express as px
     if attribute == 'Time On':
         title = 'Time On (s)'
     elif attribute == 'Time Off':
@@ -34,6 +28,8 @@ def plot_line(df, attribute):
 
 
 def plot_multiple_df(df_list, attribute):
+    import plotly.graph_objs as go
+    from plotly.subplots import make_subplots
 
     df_eos = df_list[0]
     df_ren = df_list[1]
@@ -65,6 +61,7 @@ def plot_multiple_df(df_list, attribute):
     # fig.show()
 
 def plot_time_bars(wide_df):
+    import plotly.express as px
     fig = px.bar(wide_df, x='Layer', y=['time on', 'time off'], title="Aconity Time")
     fig.update_yaxes(title="Time (s)")
     fig.show()